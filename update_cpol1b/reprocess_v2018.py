@@ -13,21 +13,29 @@ variables.
 import os
 import glob
 import uuid
+import queue
+import shutil
 import zipfile
 import argparse
 import datetime
+import threading
 
 import dask
-import dask.bag as db
+import netCDF4
+import numcodecs
+import numpy as np
 import pandas as pd
 import xarray as xr
 
+from dask.distributed import Client, as_completed
 
-def good_keys():
-    """
-    List of keys to keep in the final dataset.
-    """
-    keep_keys = [
+
+# Minimum number of rows of the first dimension copied at once.
+_COPY_ROWS = 1024
+
+# Keys to keep in the final dataset.
+_KEEP_KEYS = frozenset(
+    [
         "time",
         "range",
         "azimuth",
@@ -67,8 +75,7 @@ def good_keys():
         "instrument_type",
         "primary_axis",
     ]
-
-    return keep_keys
+)
 
 
 def get_metadata(radar_start_date, radar_end_date):
@@ -160,6 +167,94 @@ def get_metadata(radar_start_date, radar_end_date):
     return metadata
 
 
+def get_encoding(ncvar):
+    """
+    Compression settings for writing a variable. The shuffle filter with a
+    low deflate level gives nearly the same compression ratio as the default
+    level for a fraction of the write time. The on-disk chunk sizes of the
+    input are kept.
+
+    Parameters:
+    ===========
+    ncvar: netCDF4.Variable
+        Input variable.
+
+    Returns:
+    ========
+    encoding: dict
+        Keyword arguments for netCDF4.Dataset.createVariable.
+    """
+    encoding = {"zlib": True, "complevel": 1, "shuffle": True}
+    chunking = ncvar.chunking()
+    if chunking is not None and chunking != "contiguous":
+        encoding["chunksizes"] = chunking
+
+    return encoding
+
+
+def copy_dataset(src, dst):
+    """
+    Copy the variables to keep from one netCDF file to another. The data are
+    copied raw, without masking, scaling or string conversion, in blocks of
+    the first dimension. The first block of every packed variable is read
+    back and compared with the input.
+
+    Parameters:
+    ===========
+    src: netCDF4.Dataset
+        Input dataset.
+    dst: netCDF4.Dataset
+        Output dataset.
+    """
+    for ncid in (src, dst):
+        ncid.set_auto_maskandscale(False)
+        ncid.set_auto_chartostring(False)
+
+    variables = [v for k, v in src.variables.items() if k in _KEEP_KEYS]
+    dimensions = {d for v in variables for d in v.dimensions}
+    for name, dim in src.dimensions.items():
+        if name in dimensions:
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+    for var in variables:
+        attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+        encoding = get_encoding(var)
+        ncvar = dst.createVariable(
+            var.name,
+            var.datatype,
+            var.dimensions,
+            fill_value=attrs.pop("_FillValue", None),
+            **encoding,
+        )
+        # The dataset-wide settings do not apply to variables created after
+        # them: without this, the raw packed values would be scaled again
+        # once scale_factor is set.
+        ncvar.set_auto_maskandscale(False)
+        ncvar.set_auto_chartostring(False)
+        ncvar.setncatts(attrs)
+
+        if var.ndim == 0:
+            ncvar[...] = var[...]
+            continue
+        # Copy whole numbers of chunks, in blocks of at least _COPY_ROWS rows:
+        # Py-ART files are chunked one ray at a time.
+        nrows = var.shape[0]
+        chunk = max(encoding.get("chunksizes", var.shape)[0], 1)
+        step = max(chunk, (_COPY_ROWS // chunk) * chunk)
+        for start in range(0, nrows, step):
+            # Clip the slice, netCDF4 does not on unlimited dimensions.
+            stop = min(start + step, nrows)
+            ncvar[start:stop] = var[start:stop]
+
+        # Check that the packed values went through untouched.
+        if "scale_factor" in attrs or "add_offset" in attrs:
+            stop = min(step, nrows)
+            if not np.array_equal(ncvar[:stop], var[:stop]):
+                raise ValueError(f"Raw values of {var.name} changed during the copy.")
+
+    return None
+
+
 def mkdir(path):
     """
     Create a directory.
@@ -221,7 +316,103 @@ def extract_zip(inzip, path):
     return dates, namelist
 
 
-def update_dataset(radar_file, path):
+def extract_all(ziplist, path, zqueue):
+    """
+    Extract the zip files one after the other and put them on a queue, so
+    that the next archive is extracted while the current one is processed.
+
+    Parameters:
+    ===========
+    ziplist: list
+        List of zip files to extract
+    path: str
+        Path specifies a directory to extract to.
+    zqueue: queue.Queue
+        Queue receiving the (dates, namelist) tuples. None is put on the
+        queue once all the archives have been extracted, or the exception
+        if an extraction failed.
+    """
+    try:
+        for zfile in ziplist:
+            zqueue.put(extract_zip(zfile, path))
+    except Exception as error:
+        zqueue.put(error)
+    else:
+        zqueue.put(None)
+    return None
+
+
+def check_zarr_support():
+    """
+    Check that the installed xarray can write Zarr format 2 stores. The
+    zarr_format argument of to_zarr appeared in xarray 2024.10.
+    """
+    version = tuple(int(v) for v in xr.__version__.split(".")[:2] if v.isdigit())
+    if version < (2024, 10):
+        raise RuntimeError(
+            f"Zarr output needs xarray >= 2024.10, found {xr.__version__}."
+        )
+    return None
+
+
+def write_zarr(radar_file, outfilename, metadata):
+    """
+    Write the variables to keep as a Zarr (format 2) store, chunked on the
+    sweep length.
+    Each chunk is a separate object, so the store can be written and read in
+    parallel without the HDF5 file lock. The numcodecs compressor encoding is
+    only valid for Zarr format 2, zarr_format=2 needs xarray >= 2024.10. The
+    store is written under a temporary name and renamed once complete.
+
+    Parameters:
+    ===========
+    radar_file: str
+        Path to input radar file.
+    outfilename: str
+        Path to output Zarr store.
+    metadata: dict
+        Global attributes.
+    """
+    with xr.open_dataset(
+        radar_file, engine="h5netcdf", decode_cf=False, chunks={}
+    ) as dset:
+        dset = dset.drop_vars(set(dset.variables) - _KEEP_KEYS)
+        # The on-disk chunks of Py-ART files are single rays, far too small
+        # for a Zarr store. Use chunks of the most common sweep length
+        # instead: each sweep is one chunk when all the sweeps have the same
+        # number of rays, otherwise some sweeps straddle two chunks.
+        rays_per_sweep = (
+            dset.sweep_end_ray_index - dset.sweep_start_ray_index + 1
+        ).values
+        nrays, counts = np.unique(rays_per_sweep, return_counts=True)
+        chunks = {d: -1 for d in dset.dims}
+        chunks["time"] = int(min(nrays[counts.argmax()], dset.sizes["time"]))
+        dset = dset.chunk(chunks)
+        for v in dset.variables.values():
+            v.encoding.pop("chunksizes", None)
+            v.encoding.pop("preferred_chunks", None)
+        dset.attrs = metadata
+
+        compressor = numcodecs.Blosc(
+            cname="zstd", clevel=3, shuffle=numcodecs.Blosc.BITSHUFFLE
+        )
+        tmpstore = f"{outfilename}.{os.getpid()}.tmp"
+        try:
+            dset.to_zarr(
+                tmpstore,
+                mode="w",
+                zarr_format=2,
+                encoding={k: {"compressor": compressor} for k in dset.variables},
+            )
+            os.replace(tmpstore, outfilename)
+        except Exception:
+            shutil.rmtree(tmpstore, ignore_errors=True)
+            raise
+
+    return None
+
+
+def update_dataset(radar_file, path, fmt="netcdf"):
     """
     Processing to update the old CPOL level 1b data.
 
@@ -231,6 +422,8 @@ def update_dataset(radar_file, path):
         Path to input radar file.
     path: str
         Path specifies a directory to write the output file to.
+    fmt: str
+        Output format, "netcdf" or "zarr".
 
     Return:
     =======
@@ -238,52 +431,84 @@ def update_dataset(radar_file, path):
         Return None if processing failed, otherwise it returns the path to
         input radar file, so that you can delete the input latter.
     """
-    dset = xr.open_dataset(radar_file)
-    radar_start_date = dset.time[0].values
-    radar_end_date = dset.time[-1].values
+    with netCDF4.Dataset(radar_file) as src:
+        time = src.variables["time"]
+        radar_time = netCDF4.num2date(
+            [time[0], time[-1]],
+            time.units,
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+        radar_start_date = np.datetime64(radar_time[0], "ns")
+        radar_end_date = np.datetime64(radar_time[-1], "ns")
+
+        fname = "twp10cpolppi.b1.{}00.nc".format(
+            pd.Timestamp(radar_start_date).strftime("%Y%m%d.%H%M")
+        )
+        if fmt == "zarr":
+            fname = fname.replace(".nc", ".zarr")
+        outfilename = os.path.join(path, fname)
+        if os.path.exists(outfilename):
+            print(f"File already exists.")
+            return None
+
+        metadata = get_metadata(radar_start_date, radar_end_date)
+        metadata["product_version"] = "v" + src.product_version
+        metadata["version"] = "v" + src.product_version
+        metadata["date_created"] = src.created
+        metadata["history"] = (
+            "created by Valentin Louf on raijin.nci.org.au at "
+            + src.created
+            + " using Py-ART"
+        )
+
+        if fmt == "netcdf":
+            # Straight netCDF to netCDF copy of the variables to keep, the
+            # data are never decoded. The file gets its final name only once
+            # complete, a partial file would be skipped by the next run.
+            tmpfile = f"{outfilename}.{os.getpid()}.tmp"
+            try:
+                with netCDF4.Dataset(tmpfile, "w", format=src.data_model) as dst:
+                    dst.setncatts(metadata)
+                    copy_dataset(src, dst)
+                os.replace(tmpfile, outfilename)
+            except Exception:
+                remove([tmpfile])
+                raise
+
+    if fmt == "zarr":
+        write_zarr(radar_file, outfilename, metadata)
 
-    fname = "twp10cpolppi.b1.{}00.nc".format(
-        pd.Timestamp(radar_start_date).strftime("%Y%m%d.%H%M")
-    )
-    outfilename = os.path.join(path, fname)
-    if os.path.exists(outfilename):
-        print(f"File already exists.")
-        return None
-
-    keep_keys = good_keys()
-    keylist = [k for k in dset.variables.keys()]
-    for k in keylist:
-        if k not in keep_keys:
-            dset = dset.drop(k)
-
-    metadata = get_metadata(radar_start_date, radar_end_date)
-    metadata["product_version"] = "v" + dset.attrs["product_version"]
-    metadata["version"] = "v" + dset.attrs["product_version"]
-    metadata["date_created"] = (dset.attrs["created"],)
-    metadata["history"] = (
-        "created by Valentin Louf on raijin.nci.org.au at "
-        + dset.attrs["created"]
-        + " using Py-ART",
-    )
-    dset.attrs = metadata
-
-    dset.to_netcdf(
-        outfilename, encoding={k: {"zlib": True} for k in dset.variables.keys()}
-    )
     if not os.path.exists(outfilename):
         print(f"Output file does not exist !!!.")
         return None
 
-    del dset
     return radar_file
 
 
+def remove_processed(future):
+    """
+    Remove the input file of a completed update_dataset task.
+
+    Parameters:
+    ===========
+    future: distributed.Future
+        Completed update_dataset task.
+    """
+    try:
+        remove([future.result()])
+    except Exception as error:
+        print("function raised %s" % error)
+    return None
+
+
 def main():
     """
     1/ List all zip files for a given year,
-    2/ Extract one zip file (each representing one day) at a time,
+    2/ Extract the zip files (each representing one day) in a background
+       thread, ahead of the processing,
     3/ Processing (updating) and removing obsolete keys,
-    4/ Removing extracted files.
+    4/ Removing extracted files as soon as they are processed.
     """
     zipdir = "/scratch/kl02/vhl548"
     ziplist = sorted(
@@ -292,14 +517,47 @@ def main():
     if len(ziplist) == 0:
         print("No file found.")
         return None
+    if FORMAT == "zarr":
+        check_zarr_support()
 
-    for zfile in ziplist:
-        dates, namelist = extract_zip(zfile, zipdir)
-        outpath = f"/scratch/kl02/vhl548/tmpcpol/{dates}"
-        mkdir(outpath)
-        bag = db.from_sequence([(n, outpath) for n in namelist]).starmap(update_dataset)
-        rslt = bag.compute()
-        remove(rslt)
+    zqueue = queue.Queue(maxsize=2)
+    producer = threading.Thread(
+        target=extract_all, args=(ziplist, zipdir, zqueue), daemon=True
+    )
+    producer.start()
+
+    # One cluster for the whole year, instead of starting a new pool of
+    # workers for each zip file.
+    with Client(
+        n_workers=os.cpu_count(), threads_per_worker=1, memory_limit="4GB"
+    ) as client:
+        pending = as_completed()
+        error = None
+        while True:
+            item = zqueue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                error = item
+                break
+            dates, namelist = item
+            outpath = f"/scratch/kl02/vhl548/tmpcpol/{dates}"
+            mkdir(outpath)
+            futures = client.map(
+                update_dataset, namelist, [outpath] * len(namelist), fmt=FORMAT
+            )
+            pending.update(futures)
+            # Keep the next day queued behind the current one, instead of
+            # waiting for the whole day to finish before submitting it.
+            while pending.count() > len(namelist):
+                remove_processed(next(pending))
+
+        for future in pending:
+            remove_processed(future)
+
+    # Fail once the days already extracted are done.
+    if error is not None:
+        raise error
 
     return None
 
@@ -310,7 +568,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "-y", "--year", dest="year", type=int, help="Year to process.", required=True
     )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="format",
+        default="netcdf",
+        choices=["netcdf", "zarr"],
+        type=str,
+        help="Output format.",
+    )
 
     args = parser.parse_args()
     YEAR = args.year
+    FORMAT = args.format
     main()
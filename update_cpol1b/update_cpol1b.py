@@ -7,114 +7,505 @@ CPOL Level 1b update products.
 @institution: Bureau of Meteorology and Monash University
 """
 import os
-import glob
-import copy
+import re
 import uuid
+import pickle
+import hashlib
 import argparse
 import datetime
 import warnings
 import traceback
 
 import pyart
-import cftime
+import netCDF4
 import numpy as np
-import xarray as xr
 
-from concurrent.futures import TimeoutError
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from pebble import ProcessPool, ProcessExpired
 
+# Private helpers of pyart.io.cfradial, as in Py-ART 1.x. The instrument
+# parameters are read the same way as pyart.io.read_cfradial does, or with
+# the key list and conversion below if a Py-ART release drops them.
+try:
+    from pyart.io.cfradial import _INSTRUMENT_PARAMS_DIMS, _ncvar_to_dict
+
+    _IP_KEYS = tuple(_INSTRUMENT_PARAMS_DIMS.keys())
+except ImportError:
+    _IP_KEYS = (
+        "frequency",
+        "follow_mode",
+        "pulse_width",
+        "prt_mode",
+        "prt",
+        "prt_ratio",
+        "polarization_mode",
+        "nyquist_velocity",
+        "unambiguous_range",
+        "n_samples",
+        "sampling_ratio",
+        "radar_antenna_gain_h",
+        "radar_antenna_gain_v",
+        "radar_beam_width_h",
+        "radar_beam_width_v",
+        "radar_receiver_bandwidth",
+    )
 
-def chunks(l, n):
+    def _ncvar_to_dict(ncvar):
+        """Py-ART style dictionnary of a netCDF variable."""
+        param = {attr: ncvar.getncattr(attr) for attr in ncvar.ncattrs()}
+        param["data"] = ncvar[:]
+        if param["data"].shape == ():
+            param["data"].shape = (1,)
+        return param
+
+
+_MKDIR_CACHE = set()
+_IP_CACHE = dict()
+IP_CACHE_DIR = os.path.expanduser("~/.cache/update_cpol1b")
+# Bump when the output of read_instrument_parameters changes.
+_IP_CACHE_VERSION = 2
+
+# Level 1a file used for the instrument parameters when the matching one is
+# missing.
+_FALLBACK_LEVEL_1A = "/g/data/hj10/cpol_level_1a/v2019/ppi/2017/20170304/twp10cpolppi.a1.20170304.000000.nc"
+
+# Obsolete fields.
+_KEYS_DROP = [
+    "temperature",
+    "specific_attenuation_reflectivity",
+    "specific_attenuation_differential_reflectivity",
+    "velocity_texture",
+]
+
+# Float fields: (least significant digit, fill value).
+_FIELD_SCHEMA = {
+    "D0": (2, np.nan),
+    "velocity": (2, np.nan),
+    "total_power": (2, np.nan),
+    "corrected_reflectivity": (2, np.nan),
+    "cross_correlation_ratio": (4, np.nan),
+    "corrected_differential_reflectivity": (4, np.nan),
+    "corrected_differential_phase": (4, np.nan),
+    "corrected_specific_differential_phase": (4, np.nan),
+    "differential_reflectivity": (4, np.nan),
+    "differential_phase": (4, np.nan),
+    "spectrum_width": (4, np.nan),
+    "signal_to_noise_ratio": (2, np.nan),
+    "corrected_velocity": (2, np.nan),
+}
+
+# Attributes wrongly set on the fields of the previous version.
+_BAD_ATTRS = frozenset(("grid_mapping", "coordinates", "sampling_ratio"))
+
+_MAXLON = "132.385"
+_MINLON = "129.703"
+_MAXLAT = "-10.941"
+_MINLAT = "-13.552"
+
+# Metadata common to every file, only history and uuid change between files.
+_STATIC_META = {
+    "Conventions": "CF/Radial instrument_parameters",
+    "acknowledgement": "This work has been supported by the U.S. Department of Energy Atmospheric Systems Research Program through the grant DE-SC0014063. Data may be freely distributed.",
+    "country": "Australia",
+    "creator_email": "valentin.louf@monash.edu",
+    "creator_name": "Valentin Louf",
+    "geospatial_bounds": f"({_MINLON}, {_MAXLON}, {_MINLAT}, {_MAXLAT})",
+    "geospatial_lat_max": _MAXLAT,
+    "geospatial_lat_min": _MINLAT,
+    "geospatial_lat_units": "degrees_north",
+    "geospatial_lon_max": _MAXLON,
+    "geospatial_lon_min": _MINLON,
+    "geospatial_lon_units": "degrees_east",
+    "institution": "Monash University and Australian Bureau of Meteorology",
+    "instrument_name": "CPOL",
+    "instrument_type": "radar",
+    "naming_authority": "au.org.nci",
+    "origin_altitude": "50",
+    "origin_latitude": "-12.2488",
+    "origin_longitude": "131.0444",
+    "platform_is_mobile": "false",
+    "processing_level": "b1",
+    "publisher_name": "NCI",
+    "publisher_url": "nci.gov.au",
+    "references": "cf. doi:10.1175/JTECH-D-18-0007.1",
+    "site_name": "Gunn_Pt",
+    "source": "rapic",
+    "state": "NT",
+    "title": "radar PPI volume from CPOL",
+    "version": "1.3",
+}
+_HISTORY_PREFIX = "created by Valentin Louf on raijin.nci.org.au at "
+
+
+def find_nc(root):
     """
-    Yield successive n-sized chunks from l.
-    From http://stackoverflow.com/a/312464
+    Recursively yield the netCDF files found under root. os.scandir gets the
+    file type from the directory entries, so no stat is needed per file.
+
+    Parameter:
+    ==========
+    root: str
+        Directory to search.
     """
-    for i in range(0, len(l), n):
-        yield l[i : i + n]
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".nc"):
+                    yield entry.path
 
 
 def get_metadata():
-    today = datetime.datetime.utcnow()
-    maxlon = "132.385"
-    minlon = "129.703"
-    maxlat = "-10.941"
-    minlat = "-13.552"
-    origin_altitude = "50"
-    origin_latitude = "-12.2488"
-    origin_longitude = "131.0444"
-
-    metadata = dict()
-    metadata["Conventions"] = "CF/Radial instrument_parameters"
-    metadata[
-        "acknowledgement"
-    ] = "This work has been supported by the U.S. Department of Energy Atmospheric Systems Research Program through the grant DE-SC0014063. Data may be freely distributed."
-    metadata["country"] = "Australia"
-    metadata["creator_email"] = "valentin.louf@monash.edu"
-    metadata["creator_name"] = "Valentin Louf"
-    metadata["geospatial_bounds"] = f"({minlon}, {maxlon}, {minlat}, {maxlat})"
-    metadata["geospatial_lat_max"] = maxlat
-    metadata["geospatial_lat_min"] = minlat
-    metadata["geospatial_lat_units"] = "degrees_north"
-    metadata["geospatial_lon_max"] = maxlon
-    metadata["geospatial_lon_min"] = minlon
-    metadata["geospatial_lon_units"] = "degrees_east"
+    """
+    Metadata for one output file.
+
+    Returns:
+    ========
+    metadata: dict
+        Metadata attributes dictionnary.
+    """
+    metadata = _STATIC_META.copy()
     metadata["history"] = (
-        "created by Valentin Louf on raijin.nci.org.au at "
-        + today.isoformat()
-        + " using Py-ART"
+        _HISTORY_PREFIX + datetime.datetime.utcnow().isoformat() + " using Py-ART"
     )
-    metadata["institution"] = "Monash University and Australian Bureau of Meteorology"
-    metadata["instrument_name"] = "CPOL"
-    metadata["instrument_type"] = "radar"
-    metadata["naming_authority"] = "au.org.nci"
-    metadata["origin_altitude"] = origin_altitude
-    metadata["origin_latitude"] = origin_latitude
-    metadata["origin_longitude"] = origin_longitude
-    metadata["platform_is_mobile"] = "false"
-    metadata["processing_level"] = "b1"
-    metadata["publisher_name"] = "NCI"
-    metadata["publisher_url"] = "nci.gov.au"
-    metadata["references"] = "cf. doi:10.1175/JTECH-D-18-0007.1"
-    metadata["site_name"] = "Gunn_Pt"
-    metadata["source"] = "rapic"
-    metadata["state"] = "NT"
-    metadata["title"] = "radar PPI volume from CPOL"
     metadata["uuid"] = str(uuid.uuid4())
-    metadata["version"] = "1.3"
 
     return metadata
 
 
-def update_data(infile):
+def mkdir(path):
     """
-    Processing to update the old CPOL level 1b data.
+    Create a directory and its parents. The directories already created by
+    this process are remembered, so that thousands of files going to the same
+    directory do not cost one filesystem call each.
+
+    Parameters:
+    ===========
+    path: str
+        Path to directory
+    """
+    if path in _MKDIR_CACHE:
+        return None
+
+    os.makedirs(path, exist_ok=True)
+    _MKDIR_CACHE.add(path)
+    return None
+
+
+def get_date_from_filename(infile):
+    """
+    Parse the start date of the volume from the input file name, e.g.
+    cfrad.20170304_000006.000_to_20170304_000826.000_CPOL_PPI_level1b.nc
 
     Parameter:
     ==========
-    input_file: str
+    infile: str
         Path to input radar file.
+
+    Returns:
+    ========
+    date: datetime
+        Start date of the volume, None if the file name does not contain it.
+    """
+    match = re.search(r"(\d{8}_\d{6})", os.path.basename(infile))
+    if match is None:
+        return None
+
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M%S")
+
+
+def get_start_date(radar):
+    """
+    Start date of the radar volume. CF/Radial times are in seconds since a
+    reference date on the standard calendar, so plain datetime arithmetic is
+    enough.
+
+    Parameter:
+    ==========
+    radar: Radar
+        Py-ART radar object.
+
+    Returns:
+    ========
+    radar_start_date: datetime
+        Start date of the radar volume.
     """
-    radar = pyart.io.read(infile)
+    refdate = radar.time["units"].split("since ")[1].strip().rstrip("Z")
+    refdate = datetime.datetime.strptime(refdate.replace("T", " "), "%Y-%m-%d %H:%M:%S")
+    radar_start_date = refdate + datetime.timedelta(
+        seconds=float(radar.time["data"][0])
+    )
 
-    radar_start_date = cftime.num2pydate(radar.time["data"][0], radar.time["units"])
+    return radar_start_date
 
+
+def get_outfilename(radar_start_date):
+    """
+    Output file path for a radar volume.
+
+    Parameter:
+    ==========
+    radar_start_date: datetime
+        Start date of the radar volume.
+
+    Returns:
+    ========
+    outfilename: str
+        Path to the output file.
+    """
     daystr = radar_start_date.strftime("%Y%m%d")
     filename = "twp10cpolppi.b1.{}00.nc".format(
         radar_start_date.strftime("%Y%m%d.%H%M")
     )
-    outdir = os.path.join(OUTPATH, str(radar_start_date.year))
+    outfilename = os.path.join(OUTPATH, str(radar_start_date.year), daystr, filename)
+
+    return outfilename
+
+
+def read_instrument_parameters(filename):
+    """
+    Read only the instrument parameters of a CF/Radial file, in the same
+    format as Py-ART's Radar.instrument_parameters, without reading the
+    fields and sweeps of the whole volume.
+
+    Parameter:
+    ==========
+    filename: str
+        Path to CF/Radial file.
+
+    Returns:
+    ========
+    instrument_parameters: dict
+        Dictionnary of instrument parameters.
+    """
+    with netCDF4.Dataset(filename) as ncid:
+        instrument_parameters = {
+            k: _ncvar_to_dict(ncid.variables[k])
+            for k in _IP_KEYS
+            if k in ncid.variables
+        }
+
+    return instrument_parameters
+
+
+def get_ip_cachefile(filename):
+    """
+    Path of the pickled instrument parameters of a level 1a file. The name
+    depends on the path, modification time and size of the level 1a file,
+    on _IP_CACHE_VERSION and on which _ncvar_to_dict is used, so that a
+    modified file or a change in read_instrument_parameters invalidates the
+    pickle.
+
+    Parameter:
+    ==========
+    filename: str
+        Path to CF/Radial file.
+
+    Returns:
+    ========
+    cachefile: str
+        Path to the cache file.
+    """
+    stat = os.stat(filename)
+    key = (
+        f"{_IP_CACHE_VERSION}:{_ncvar_to_dict.__module__}:"
+        f"{os.path.abspath(filename)}:{stat.st_mtime_ns}:{stat.st_size}"
+    )
+    cachefile = os.path.join(IP_CACHE_DIR, hashlib.md5(key.encode()).hexdigest())
+
+    return cachefile + ".pkl"
+
+
+def save_ip_cachefile(cachefile, instrument_parameters):
+    """
+    Pickle the instrument parameters. The file is written under a temporary
+    name and then renamed, as several workers may write the same file. A
+    failure only means that the file will be read again next time.
+
+    Parameters:
+    ===========
+    cachefile: str
+        Path to the cache file.
+    instrument_parameters: dict
+        Dictionnary of instrument parameters.
+    """
+    tmpfile = f"{cachefile}.{os.getpid()}"
     try:
-        os.mkdir(outdir)
-    except FileExistsError:
-        pass
+        mkdir(IP_CACHE_DIR)
+        with open(tmpfile, "wb") as fid:
+            pickle.dump(instrument_parameters, fid, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        traceback.print_exc()
+
+    return None
+
+
+def freeze_instrument_parameters(instrument_parameters):
+    """
+    Make the instrument parameters read-only, so that they can be shared
+    between volumes without copying them. Py-ART only reads them when
+    writing the file.
+
+    Parameter:
+    ==========
+    instrument_parameters: dict
+        Dictionnary of instrument parameters.
+
+    Returns:
+    ========
+    instrument_parameters: MappingProxyType
+        Read-only view of the dictionnary, with read-only data arrays.
+    """
+    for param in instrument_parameters.values():
+        param["data"].setflags(write=False)
+        mask = np.ma.getmask(param["data"])
+        if mask is not np.ma.nomask:
+            mask.setflags(write=False)
+
+    return MappingProxyType(instrument_parameters)
+
+
+def load_fallback_parameters(filename):
+    """
+    Instrument parameters of the fallback level 1a file, from the pickle in
+    IP_CACHE_DIR when it is there, so that later runs do not open the level
+    1a file again.
 
-    outdir_day = os.path.join(outdir, daystr)
+    Parameter:
+    ==========
+    filename: str
+        Path to CF/Radial file.
+
+    Returns:
+    ========
+    instrument_parameters: dict
+        Dictionnary of instrument parameters.
+    """
+    cachefile = get_ip_cachefile(filename)
     try:
-        os.mkdir(outdir_day)
-    except FileExistsError:
+        with open(cachefile, "rb") as fid:
+            return pickle.load(fid)
+    except (OSError, EOFError, pickle.UnpicklingError):
         pass
 
-    outfilename = os.path.join(outdir_day, filename)
+    instrument_parameters = read_instrument_parameters(filename)
+    save_ip_cachefile(cachefile, instrument_parameters)
+
+    return instrument_parameters
+
+
+def get_instrument_parameters(filename):
+    """
+    Instrument parameters of a level 1a file. Most volumes with a missing
+    level 1a file use the same fallback file, its parameters are kept in
+    memory for the life of the process and pickled on disk. The other level
+    1a files are each used by a single volume and are read directly.
+
+    Parameter:
+    ==========
+    filename: str
+        Path to CF/Radial file.
+
+    Returns:
+    ========
+    instrument_parameters: dict or MappingProxyType
+        Dictionnary of instrument parameters. The fallback parameters are
+        read-only, shared by all the volumes using them.
+    """
+    if filename != _FALLBACK_LEVEL_1A:
+        return read_instrument_parameters(filename)
+
+    if filename not in _IP_CACHE:
+        _IP_CACHE[filename] = freeze_instrument_parameters(
+            load_fallback_parameters(filename)
+        )
+
+    return _IP_CACHE[filename]
+
+
+def fill_masked(data, fvalue, dtype=None):
+    """
+    Write the fill value in the masked gates and return the plain array,
+    without the mask. With the _FillValue set on the field, Py-ART hands the
+    array to netCDF4 as it is, instead of netCDF4 making a filled copy of
+    the masked array while writing.
+
+    Parameters:
+    ===========
+    data: np.ma.MaskedArray
+        Field data.
+    fvalue: float or int
+        Fill value.
+    dtype: np.dtype
+        Output data type. The data are cast only if their type differs,
+        otherwise the fill value is written in place.
+
+    Returns:
+    ========
+    values: np.ndarray
+        Filled field data.
+    """
+    mask = np.ma.getmask(data)
+    values = np.ma.getdata(data)
+    if dtype is not None and values.dtype != dtype:
+        values = values.astype(dtype)
+    if mask is not np.ma.nomask:
+        np.copyto(values, fvalue, where=mask)
+
+    return values
+
+
+def encode_field(field, key):
+    """
+    Cast a float field to float32 and set its fill value and precision as
+    given in _FIELD_SCHEMA.
+
+    Parameters:
+    ===========
+    field: dict
+        Py-ART field dictionnary, modified in place.
+    key: str
+        Field name.
+    """
+    least_digit, fvalue = _FIELD_SCHEMA[key]
+    try:
+        field["data"] = fill_masked(field["data"], fvalue, np.float32)
+        field["_Least_significant_digit"] = least_digit
+        field["_FillValue"] = fvalue
+    except Exception:
+        traceback.print_exc()
+
+    return None
+
+
+def update_data(infile):
+    """
+    Processing to update the old CPOL level 1b data.
+
+    Parameter:
+    ==========
+    input_file: str
+        Path to input radar file.
+    """
+    # Skip files already processed before reading them.
+    filename_date = get_date_from_filename(infile)
+    if filename_date is not None and os.path.exists(get_outfilename(filename_date)):
+        print(f"Output file already exists for {infile}.")
+        return None
+
+    # The input is always CF/Radial, no need for pyart.io.read to open the
+    # file to guess its format. The obsolete fields are not read at all.
+    radar = pyart.io.read_cfradial(infile, exclude_fields=_KEYS_DROP)
+
+    radar_start_date = get_start_date(radar)
+    daystr = radar_start_date.strftime("%Y%m%d")
+    outfilename = get_outfilename(radar_start_date)
+
+    mkdir(os.path.dirname(outfilename))
 
     # Get original level 1a file for copying intstrument parameters
     datestr = radar_start_date.strftime("%Y%m%d.%H%M")
@@ -124,108 +515,76 @@ def update_data(infile):
     )
     if not os.path.isfile(fone):
         print(f"{fone} is missing.")
-        fone = "/g/data/hj10/cpol_level_1a/v2019/ppi/2017/20170304/twp10cpolppi.a1.20170304.000000.nc"
-    oned = pyart.io.read(fone)
-
-    radar.instrument_parameters = oned.instrument_parameters
+        fone = _FALLBACK_LEVEL_1A
+    radar.instrument_parameters = get_instrument_parameters(fone)
     radar.metadata = get_metadata()
     radar.radar_calibration = None
 
-    # Drop Obsolete keys
-    keys_drop = [
-        "temperature",
-        "specific_attenuation_reflectivity",
-        "specific_attenuation_differential_reflectivity",
-        "velocity_texture",
-    ]
-
-    klist = list(radar.fields.keys())
-    for key in klist:
-        if key in keys_drop:
-            radar.fields.pop(key)
-
-    # Rename the reflectivity
-    try:
-        radar.add_field("corrected_reflectivity", radar.fields.pop("reflectivity"))
-        radar.fields["corrected_reflectivity"]["data"] = radar.fields[
-            "corrected_reflectivity"
-        ]["data"].filled(np.NaN)
-        radar.fields["corrected_reflectivity"]["data"] = np.ma.masked_invalid(
-            radar.fields["corrected_reflectivity"]["data"]
-        )
-        np.ma.set_fill_value(radar.fields["corrected_reflectivity"]["data"], np.NaN)
-    except Exception:
-        traceback.print_exc()
-        pass
+    # Rename the reflectivity. Fields are renamed with plain dictionary swaps,
+    # add_field would check again arrays that Py-ART has just read.
+    if "reflectivity" in radar.fields:
+        radar.fields["corrected_reflectivity"] = radar.fields.pop("reflectivity")
 
     # Rename the 2 Velocity fields
-    try:
+    if "raw_velocity" in radar.fields:
         radar.fields["velocity"] = radar.fields.pop("raw_velocity")
-        radar.add_field(
-            "corrected_velocity", radar.fields.pop("region_dealias_velocity")
+    if "region_dealias_velocity" in radar.fields:
+        radar.fields["corrected_velocity"] = radar.fields.pop(
+            "region_dealias_velocity"
         )
-    except Exception:
-        pass
 
     # Make sure echo class is an integer array and fix its fillvalue.
-    try:
-        radar.fields["radar_echo_classification"]["data"] = radar.fields[
-            "radar_echo_classification"
-        ]["data"].astype(np.int32)
-        np.ma.set_fill_value(radar.fields["radar_echo_classification"]["data"], -9999)
+    if "radar_echo_classification" in radar.fields:
+        radar.fields["radar_echo_classification"]["data"] = fill_masked(
+            radar.fields["radar_echo_classification"]["data"], -9999, np.int32
+        )
         radar.fields["radar_echo_classification"]["_FillValue"] = -9999
-    except Exception:
-        pass
 
-    radar.fields["radar_estimated_rain_rate"]["_Least_significant_digit"] = 2
+    if "radar_estimated_rain_rate" in radar.fields:
+        radar.fields["radar_estimated_rain_rate"]["_Least_significant_digit"] = 2
 
-    try:
-        radar.fields["NW"].pop("standard_name")
-        np.ma.set_fill_value(radar.fields["NW"]["data"], np.NaN)
-        radar.fields["NW"]["_FillValue"] = np.NaN
+    if "NW" in radar.fields:
+        radar.fields["NW"].pop("standard_name", None)
+        radar.fields["NW"]["data"] = fill_masked(radar.fields["NW"]["data"], np.nan)
+        radar.fields["NW"]["_FillValue"] = np.nan
         radar.fields["NW"]["_Least_significant_digit"] = 2
-        radar.fields["NW"]["data"] = np.ma.masked_invalid(radar.fields["NW"]["data"])
-    except Exception:
-        pass
-
-    klist_pr = [
-        ("D0", 2, np.NaN),
-        ("velocity", 2, np.NaN),
-        ("total_power", 2, np.NaN),
-        ("corrected_reflectivity", 2, np.NaN),
-        ("cross_correlation_ratio", 4, np.NaN),
-        ("corrected_differential_reflectivity", 4, np.NaN),
-        ("corrected_differential_phase", 4, np.NaN),
-        ("corrected_specific_differential_phase", 4, np.NaN),
-        ("differential_reflectivity", 4, np.NaN),
-        ("differential_phase", 4, np.NaN),
-        ("spectrum_width", 4, np.NaN),
-        ("signal_to_noise_ratio", 2, np.NaN),
-        ("corrected_velocity", 2, np.NaN),
-    ]
-
-    for key, least_digit, fvalue in klist_pr:
-        if key not in klist:
-            continue
-        try:
-            np.ma.set_fill_value(radar.fields[key]["data"], fvalue)
-            radar.fields[key]["data"] = radar.fields[key]["data"].astype(np.float32)
-            radar.fields[key]["_Least_significant_digit"] = least_digit
-            radar.fields[key]["_FillValue"] = fvalue
-        except Exception:
-            traceback.print_exc()
-            continue
 
-    # Remove wrongfull attributes.
-    bad_attr = ["grid_mapping", "coordinates", "sampling_ratio"]
-    for k in radar.fields.keys():
-        for badk in bad_attr:
-            try:
-                radar.fields[k].pop(badk)
-            except KeyError:
-                pass
+    # NumPy releases the GIL while casting and filling large arrays, and each
+    # thread only modifies its own field.
+    keys = _FIELD_SCHEMA.keys() & radar.fields.keys()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda k: encode_field(radar.fields[k], k), keys))
+
+    # Chunks of the most common sweep length. When all the sweeps have the
+    # same number of rays, each sweep is exactly one chunk and is read and
+    # decompressed on its own. Otherwise the sweeps of a different length
+    # straddle chunk boundaries, netCDF4 chunks have a fixed size. Py-ART
+    # passes these keys on to netCDF4.createVariable.
+    rays_per_sweep = (
+        radar.sweep_end_ray_index["data"] - radar.sweep_start_ray_index["data"] + 1
+    )
+    nrays, counts = np.unique(rays_per_sweep, return_counts=True)
+    chunksizes = (int(min(nrays[counts.argmax()], radar.nrays)), radar.ngates)
+
+    # Remove wrongfull attributes and set the compression.
+    for field in radar.fields.values():
+        for badk in _BAD_ATTRS & field.keys():
+            del field[badk]
+        field["_ChunkSizes"] = chunksizes
+        field["_DeflateLevel"] = 1
+        field["_Shuffle"] = True
+
+    # Write under a temporary name, so that a worker killed mid-write does
+    # not leave a truncated file that the next run would skip.
+    tmpfile = f"{outfilename}.{os.getpid()}.tmp"
+    try:
+        pyart.io.write_cfradial(tmpfile, radar)
+        os.replace(tmpfile, outfilename)
+    except Exception:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
 
-    pyart.io.write_cfradial(outfilename, radar)
     return None
 
 
@@ -251,29 +610,49 @@ def process_one_file(input_file):
 
 
 def main():
-    indir = os.path.join(INPATH, str(YEAR), "**", "*.nc")
-    flist = sorted(glob.glob(indir))
+    indir = os.path.join(INPATH, str(YEAR))
+    flist = sorted(find_nc(indir))
 
     print(f"Found {len(flist)} files.")
     if len(flist) == 0:
         raise FileNotFoundError(f"No file found in {indir}")
 
-    for flist_chunk in chunks(flist, 16):
-        with ProcessPool() as pool:
-            future = pool.map(update_data, flist_chunk, timeout=60)
-            iterator = future.result()
-
-            while True:
-                try:
-                    result = next(iterator)
-                except StopIteration:
-                    break
-                except TimeoutError as error:
-                    print("function took longer than %d seconds" % error.args[1])
-                except ProcessExpired as error:
-                    print("%s. Exit code: %d" % (error, error.exitcode))
-                except Exception as error:
-                    print("function raised %s" % error)
+    # Create all the output directories before starting the workers, the
+    # forked workers inherit _MKDIR_CACHE and do not create them again.
+    dates = [get_date_from_filename(f) for f in flist]
+    for outdir in {os.path.dirname(get_outfilename(d)) for d in dates if d}:
+        mkdir(outdir)
+
+    # Read the fallback instrument parameters once in the parent, the forked
+    # workers share the cached copy instead of each reading it again. Only
+    # the volumes that need the fallback fail if it cannot be read.
+    if os.path.isfile(_FALLBACK_LEVEL_1A):
+        try:
+            get_instrument_parameters(_FALLBACK_LEVEL_1A)
+        except Exception:
+            traceback.print_exc()
+    else:
+        print(f"{_FALLBACK_LEVEL_1A} is missing.")
+
+    # One task per file, so that a hung or crashed volume only loses itself.
+    # Workers are recycled after max_tasks files to contain Py-ART's memory
+    # growth, while the import cost is paid only once per max_tasks files.
+    with ProcessPool(max_workers=os.cpu_count(), max_tasks=64) as pool:
+        futures = [
+            pool.schedule(update_data, args=(infile,), timeout=60) for infile in flist
+        ]
+
+        for infile, future in zip(flist, futures):
+            try:
+                future.result()
+            except TimeoutError as error:
+                print(
+                    "%s: function took longer than %d seconds" % (infile, error.args[1])
+                )
+            except ProcessExpired as error:
+                print("%s: %s. Exit code: %d" % (infile, error, error.exitcode))
+            except Exception as error:
+                print("%s: function raised %s" % (infile, error))
 
     return None
 